@@ -1,10 +1,22 @@
-import json
+import asyncio
+import copy
+import hashlib
+import logging
 import re
 import os
-from typing import Dict, Any
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
 
 import httpx
-from tenacity import retry, stop_after_attempt, wait_exponential_jitter
+import orjson
+from aiolimiter import AsyncLimiter
+from tenacity import RetryCallState, retry, stop_after_attempt, wait_exponential_jitter
+
+from .models import Slide
+
+logger = logging.getLogger("text2pptx")
 
 # =========================
 # Prompts
@@ -22,23 +34,136 @@ USER_PROMPT_TMPL = (
     "Return STRICT JSON only, no prose."
 )
 
+NOTES_SYSTEM_PROMPT = (
+    "You write speaker notes for presentation slides. "
+    "You MUST answer as strict JSON with a single key: notes:[string], one entry per slide, in the given order. "
+    "Each entry: 1–3 short paragraphs a presenter can read aloud."
+)
+
+NOTES_USER_PROMPT_TMPL = (
+    "Write speaker notes for these {count} slides (JSON, in order):\n\n{slides}\n\n"
+    "Return STRICT JSON only, no prose."
+)
+
+# =========================
+# Shared HTTP client
+# =========================
+# One pooled client for all providers so TLS sessions and HTTP/2 connections
+# are reused across requests. Closed from the app's shutdown hook.
+_HTTP_CLIENT = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0),
+    limits=httpx.Limits(max_connections=2000, max_keepalive_connections=1500),
+    http2=True,
+)
+
+async def aclose_http_client():
+    await _HTTP_CLIENT.aclose()
+
+# =========================
+# Rate limiting
+# =========================
+# Token bucket per (provider, key hash) to smooth bursts before they turn into
+# 429s. Requests/minute per provider can be set via OPENAI_RPM, ANTHROPIC_RPM, GEMINI_RPM.
+_DEFAULT_RPM = 100
+
+def _rpm_from_env(provider: str) -> int:
+    name = f"{provider.upper()}_RPM"
+    raw = os.getenv(name, "")
+    if not raw:
+        return _DEFAULT_RPM
+    try:
+        rpm = int(raw)
+    except ValueError:
+        rpm = 0
+    if rpm <= 0:
+        logger.warning("Ignoring invalid %s=%r; using %d", name, raw, _DEFAULT_RPM)
+        return _DEFAULT_RPM
+    return rpm
+
+_RPM = {name: _rpm_from_env(name) for name in ("openai", "anthropic", "gemini")}
+
+# Bounded LRU: this is a bring-your-own-key service, so one limiter per key
+# would otherwise grow for the life of the worker.
+_LIMITERS_MAXSIZE = 1024
+_LIMITERS: "OrderedDict[Tuple[str, int], AsyncLimiter]" = OrderedDict()
+
+def _get_limiter(provider: str, api_key: str) -> AsyncLimiter:
+    key = (provider, hash(api_key))
+    limiter = _LIMITERS.get(key)
+    if limiter is None:
+        limiter = _LIMITERS[key] = AsyncLimiter(_RPM.get(provider, _DEFAULT_RPM), 60)
+        if len(_LIMITERS) > _LIMITERS_MAXSIZE:
+            _LIMITERS.popitem(last=False)
+    else:
+        _LIMITERS.move_to_end(key)
+    return limiter
+
 # =========================
 # Helpers
 # =========================
+_JSON_FENCE_RE = re.compile(r"```json\s*(\{.*?\})\s*```", re.S | re.I)
+
+# Upper bounds on what we scan / decode from a single model response
+_MAX_RESPONSE_CHARS = 2_000_000
+_MAX_JSON_CHARS = 512_000
+
+def _find_json_object(text: str) -> Optional[str]:
+    """Return the first balanced {...} span in text, skipping braces inside string literals."""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
 def _extract_json_maybe(text: str) -> Dict[str, Any]:
     """Extract a JSON object from model output (handles ```json fences or prose-wrapped JSON)."""
     if not text:
         raise ValueError("Empty response from model")
+    if len(text) > _MAX_RESPONSE_CHARS:
+        text = text[:_MAX_RESPONSE_CHARS]
 
-    m = re.search(r"```json\s*(\{.*?\})\s*```", text, flags=re.S | re.I)
-    if m:
-        return json.loads(m.group(1))
+    # Fast path: json_object / application/json responses are usually bare JSON
+    t = text.lstrip()
+    if t.startswith("{"):
+        try:
+            return _loads_bounded(t)
+        except ValueError:
+            pass
 
-    m = re.search(r"(\{.*\})", text, flags=re.S)
-    if m:
-        return json.loads(m.group(1))
+    if "```json" in text or "```JSON" in text:
+        m = _JSON_FENCE_RE.search(text)
+        if m:
+            return _loads_bounded(m.group(1))
 
-    return json.loads(text)
+    candidate = _find_json_object(text)
+    if candidate:
+        return _loads_bounded(candidate)
+
+    return _loads_bounded(text)
+
+def _loads_bounded(candidate: str) -> Dict[str, Any]:
+    if len(candidate) > _MAX_JSON_CHARS:
+        raise ValueError("JSON candidate too large")
+    return orjson.loads(candidate)
 
 def _raise_for_provider_error(resp: httpx.Response, provider_label: str):
     try:
@@ -51,26 +176,192 @@ def _raise_for_provider_error(resp: httpx.Response, provider_label: str):
     )
 
 # =========================
-# Entry point with retries
+# Entry point (cached) with retries
 # =========================
-@retry(stop=stop_after_attempt(3), wait=wait_exponential_jitter(initial=1, max=8))
+# Outlines keyed on (provider, model, text digest, guidance digest), built from
+# the same truncated inputs the prompt uses. The API key is deliberately not
+# part of the key; it is only needed to resolve a miss.
+_MAX_TEXT_CHARS = 60000
+_MAX_GUIDANCE_CHARS = 200
+_OUTLINE_CACHE_MAXSIZE = 1024
+_OUTLINE_CACHE: "OrderedDict[Tuple[str, str, str, str], Dict[str, Any]]" = OrderedDict()
+
 async def generate_slide_outline(provider: str, model: str, api_key: str, raw_text: str, guidance: str) -> Dict[str, Any]:
+    provider = (provider or "").strip().lower()
+    key = (
+        provider,
+        model or "",
+        hashlib.blake2b(raw_text[:_MAX_TEXT_CHARS].encode()).hexdigest(),
+        hashlib.blake2b(guidance[:_MAX_GUIDANCE_CHARS].encode()).hexdigest(),
+    )
+
+    cached = _OUTLINE_CACHE.get(key)
+    if cached is not None:
+        _OUTLINE_CACHE.move_to_end(key)
+        return copy.deepcopy(cached)
+
+    result = await _generate_with_fallback(provider, model, api_key, raw_text, guidance)
+    # Only cache outlines shaped like a deck; a malformed one must not be
+    # replayed on retry. Full validation still happens in main.analyze.
+    if isinstance(result, dict) and isinstance(result.get("slides"), list):
+        _OUTLINE_CACHE[key] = copy.deepcopy(result)
+        if len(_OUTLINE_CACHE) > _OUTLINE_CACHE_MAXSIZE:
+            _OUTLINE_CACHE.popitem(last=False)
+    return result
+
+# =========================
+# Provider fallback + circuit breakers
+# =========================
+# The user's provider is tried first, with their own key; on an outage
+# (timeout, 429, 5xx) we move down FALLBACK_ORDER, but only to providers with a
+# server-side key in the env. Fallback is opt-in: LLM_FALLBACKS is empty by
+# default, since it bills the operator's key. Every hop has a breaker keyed on
+# (provider, key hash), so one user's exhausted key never blocks anyone else.
+FALLBACK_ORDER = [p.strip().lower() for p in os.getenv("LLM_FALLBACKS", "").split(",") if p.strip()]
+
+_FALLBACK_KEY_ENV = {
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+}
+
+_BREAKER_THRESHOLD = 3       # consecutive failures before opening
+_BREAKER_COOLDOWN_S = 30.0   # how long an open breaker skips the provider
+
+@dataclass
+class CircuitBreaker:
+    failures: int = 0
+    opened_at: float = 0.0
+
+    def is_open(self) -> bool:
+        return self.failures >= _BREAKER_THRESHOLD and time.monotonic() - self.opened_at < _BREAKER_COOLDOWN_S
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= _BREAKER_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = 0.0
+
+# Bounded LRU, same reasoning as _LIMITERS (one entry per user key)
+_BREAKERS_MAXSIZE = 1024
+_BREAKERS: "OrderedDict[Tuple[str, int], CircuitBreaker]" = OrderedDict()
+
+def _get_breaker(provider: str, api_key: str) -> CircuitBreaker:
+    key = (provider, hash(api_key))
+    breaker = _BREAKERS.get(key)
+    if breaker is None:
+        breaker = _BREAKERS[key] = CircuitBreaker()
+        if len(_BREAKERS) > _BREAKERS_MAXSIZE:
+            _BREAKERS.popitem(last=False)
+    else:
+        _BREAKERS.move_to_end(key)
+    return breaker
+
+def _is_provider_outage(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TimeoutException):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+# Outages are handled by the breaker/fallback chain, so tenacity only gives a
+# 429/5xx one more try and never re-waits a timeout; other errors get 3 attempts.
+_OUTAGE_MAX_ATTEMPTS = 2
+
+def _should_retry(retry_state: RetryCallState) -> bool:
+    exc = retry_state.outcome.exception()
+    if exc is None:
+        return False
+    if isinstance(exc, httpx.TimeoutException):
+        return False
+    if _is_provider_outage(exc):
+        return retry_state.attempt_number < _OUTAGE_MAX_ATTEMPTS
+    return True
+
+def _provider_chain(provider: str, model: str, api_key: str) -> List[Tuple[str, str, str]]:
+    chain = [(provider, model, api_key)]
+    for name in FALLBACK_ORDER:
+        env_key = os.getenv(_FALLBACK_KEY_ENV.get(name, ""), "")
+        if name != provider and env_key:
+            chain.append((name, "", env_key))
+    return chain
+
+async def _generate_with_fallback(provider: str, model: str, api_key: str, raw_text: str, guidance: str) -> Dict[str, Any]:
+    last_exc: Optional[Exception] = None
+    for name, mdl, key in _provider_chain(provider, model, api_key):
+        breaker = _get_breaker(name, key)
+        if breaker.is_open():
+            continue
+        try:
+            result = await _generate_slide_outline_uncached(name, mdl, key, raw_text, guidance)
+        except Exception as e:
+            if not _is_provider_outage(e):
+                raise
+            breaker.record_failure()
+            last_exc = e
+            continue
+        breaker.record_success()
+        return result
+
+    if last_exc is not None:
+        raise last_exc
+    raise RuntimeError("LLM provider is temporarily unavailable (circuit open). Try again shortly.")
+
+@retry(retry=_should_retry, stop=stop_after_attempt(3), wait=wait_exponential_jitter(initial=1, max=8), reraise=True)
+async def _generate_slide_outline_uncached(provider: str, model: str, api_key: str, raw_text: str, guidance: str) -> Dict[str, Any]:
     payload = {
         "system": SYSTEM_PROMPT,
-        "user": USER_PROMPT_TMPL.format(raw_text=raw_text[:60000], guidance=guidance[:200])
+        "user": USER_PROMPT_TMPL.format(raw_text=raw_text[:_MAX_TEXT_CHARS], guidance=guidance[:_MAX_GUIDANCE_CHARS])
     }
 
+    return await _call_provider(provider, model, api_key, payload)
+
+# =========================
+# Speaker notes (batched calls)
+# =========================
+# Slides per call, sized so 1-3 paragraphs each stay well under the 4096-token
+# output limit, and a cap on how many slides get notes filled per deck.
+_NOTES_BATCH_SIZE = 10
+_NOTES_MAX_SLIDES = 40
+
+async def fill_missing_notes_batch(provider: str, model: str, api_key: str, slides: List[Slide]) -> List[str]:
+    """Ask the LLM for notes for the given slides in a few batched calls; returns one string per slide, in order.
+
+    Only the first _NOTES_MAX_SLIDES slides are filled; the rest come back empty.
+    """
     provider = (provider or "").strip().lower()
+    capped = slides[:_NOTES_MAX_SLIDES]
+    batches = [capped[i:i + _NOTES_BATCH_SIZE] for i in range(0, len(capped), _NOTES_BATCH_SIZE)]
+    results = await asyncio.gather(*(_fill_notes_chunk(provider, model, api_key, b) for b in batches))
+    notes = [n for chunk in results for n in chunk]
+    return notes + [""] * (len(slides) - len(notes))
 
-    if provider == "openai":  # Use this for AI-Pipe (OpenAI-compatible)
-        return await _call_openai(model or "gpt-4o-mini", api_key, payload)
-    elif provider == "anthropic":
-        return await _call_anthropic(model or "claude-3-5-sonnet-latest", api_key, payload)
-    elif provider == "gemini":
-        return await _call_gemini(model or "gemini-1.5-pro", api_key, payload)
-    else:
+@retry(retry=_should_retry, stop=stop_after_attempt(3), wait=wait_exponential_jitter(initial=1, max=8), reraise=True)
+async def _fill_notes_chunk(provider: str, model: str, api_key: str, slides: List[Slide]) -> List[str]:
+    items = [{"title": s.title, "bullets": s.bullets} for s in slides]
+    payload = {
+        "system": NOTES_SYSTEM_PROMPT,
+        "user": NOTES_USER_PROMPT_TMPL.format(count=len(items), slides=orjson.dumps(items).decode()),
+    }
+    result = await _call_provider(provider, model, api_key, payload)
+    notes = result.get("notes")
+    if not isinstance(notes, list):
+        raise ValueError("Model response is missing a notes array")
+    notes = [n if isinstance(n, str) else "" for n in notes[:len(slides)]]
+    return notes + [""] * (len(slides) - len(notes))
+
+async def _call_provider(provider: str, model: str, api_key: str, payload: Dict[str, str]) -> Dict[str, Any]:
+    fn, default_model = _DISPATCH.get(provider, (None, None))
+    if fn is None:
         raise ValueError("Unsupported provider. Use openai|anthropic|gemini.")
 
+    async with _get_limiter(provider, api_key):
+        return await fn(model or default_model, api_key, payload)
+
 # =========================
 # OpenAI-compatible (AI-Pipe)
 # =========================
@@ -93,13 +384,12 @@ async def _call_openai(model: str, api_key: str, p: Dict[str, str]) -> Dict[str,
             {"role": "user",   "content": p["user"]},
         ],
     }
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(url, headers=headers, json=data)
-        if r.status_code >= 400:
-            _raise_for_provider_error(r, "OpenAI-compatible")
-        j = r.json()
-        content = j["choices"][0]["message"]["content"]
-        return _extract_json_maybe(content)
+    r = await _HTTP_CLIENT.post(url, headers=headers, json=data)
+    if r.status_code >= 400:
+        _raise_for_provider_error(r, "OpenAI-compatible")
+    j = orjson.loads(r.content)
+    content = j["choices"][0]["message"]["content"]
+    return _extract_json_maybe(content)
 
 # =========================
 # Anthropic
@@ -117,13 +407,12 @@ async def _call_anthropic(model: str, api_key: str, p: Dict[str, str]) -> Dict[s
         "system": p["system"],
         "messages": [{"role": "user", "content": p["user"]}],
     }
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(url, headers=headers, json=data)
-        if r.status_code >= 400:
-            _raise_for_provider_error(r, "Anthropic")
-        j = r.json()
-        content = "".join([blk.get("text", "") for blk in j.get("content", [])])
-        return _extract_json_maybe(content)
+    r = await _HTTP_CLIENT.post(url, headers=headers, json=data)
+    if r.status_code >= 400:
+        _raise_for_provider_error(r, "Anthropic")
+    j = orjson.loads(r.content)
+    content = "".join([blk.get("text", "") for blk in j.get("content", [])])
+    return _extract_json_maybe(content)
 
 # =========================
 # Gemini (native)
@@ -139,16 +428,24 @@ async def _call_gemini(model: str, api_key: str, p: Dict[str, str]) -> Dict[str,
             "maxOutputTokens": 4096,
         },
     }
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(url, json=data)
-        if r.status_code >= 400:
-            _raise_for_provider_error(r, "Gemini")
-        j = r.json()
-        if not j.get("candidates"):
-            raise ValueError(f"Gemini returned no candidates: {j}")
-        cand = j["candidates"][0]
-        parts = cand.get("content", {}).get("parts", [])
-        if not parts:
-            raise ValueError(f"Gemini returned empty parts: {j}")
-        text = parts[0].get("text", "")
-        return _extract_json_maybe(text)
+    r = await _HTTP_CLIENT.post(url, json=data)
+    if r.status_code >= 400:
+        _raise_for_provider_error(r, "Gemini")
+    j = orjson.loads(r.content)
+    if not j.get("candidates"):
+        raise ValueError(f"Gemini returned no candidates: {j}")
+    cand = j["candidates"][0]
+    parts = cand.get("content", {}).get("parts", [])
+    if not parts:
+        raise ValueError(f"Gemini returned empty parts: {j}")
+    text = parts[0].get("text", "")
+    return _extract_json_maybe(text)
+
+# =========================
+# Provider dispatch: name -> (call, default model)
+# =========================
+_DISPATCH = {
+    "openai": (_call_openai, "gpt-4o-mini"),  # Use this for AI-Pipe (OpenAI-compatible)
+    "anthropic": (_call_anthropic, "claude-3-5-sonnet-latest"),
+    "gemini": (_call_gemini, "gemini-1.5-pro"),
+}
@@ -1,9 +1,13 @@
+import asyncio
 import io
 import json
 import logging
 import os
-from typing import List
+from typing import List, Set
 
+import anyio
+import anyio.from_thread
+import anyio.to_thread
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
@@ -12,9 +16,9 @@ from starlette.requests import Request
 from starlette.responses import RedirectResponse
 from starlette.staticfiles import StaticFiles
 
-from .llm_providers import generate_slide_outline
-from .pptx_builder import build_presentation, collect_template_images
-from .models import AnalyzeResponse, GenerateRequest, SlideDeck
+from .llm_providers import aclose_http_client, fill_missing_notes_batch, generate_slide_outline
+from .pptx_builder import get_template_metadata, render_presentation
+from .models import AnalyzeResponse, SlideDeck
 from .security import MAX_FILE_SIZE_BYTES, mask_api_key, safe_len
 
 app = FastAPI(title="Text→PPTX (Template-Aware)", version="1.0.0")
@@ -37,6 +41,88 @@ logger = logging.getLogger("text2pptx")
 logger.info("OPENAI_BASE = %s", os.getenv("OPENAI_BASE", "(default: api.openai.com)"))
 # -----------------------------------
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+async def _stream_to(upload: UploadFile, buf: io.BytesIO, limit: int) -> None:
+    """Copy an upload into buf in chunks, failing with 413 as soon as it exceeds limit."""
+    total = 0
+    while True:
+        chunk = await upload.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            raise HTTPException(413, detail=f"Template too large (> {limit // (1024*1024)} MB).")
+        buf.write(chunk)
+    buf.seek(0)
+
+class _ChannelWriter(io.RawIOBase):
+    """Unseekable sink that hands each write to the event loop over an anyio stream.
+
+    Only usable from a worker thread started by anyio.to_thread.run_sync.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._broken = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        # Once the reader is gone, drop writes so a later flush (e.g. on GC) is a no-op
+        if not self._broken:
+            try:
+                anyio.from_thread.run(self._send.send, bytes(b))
+            except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+                self._broken = True
+                raise
+        return len(b)
+
+def _save_to_channel(prs, send) -> None:
+    # zipfile falls back to streaming mode (data descriptors) on unseekable output
+    out = io.BufferedWriter(_ChannelWriter(send), buffer_size=STREAM_CHUNK_SIZE)
+    try:
+        prs.save(out)
+        out.flush()
+    except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+        pass  # client went away mid-download
+    finally:
+        anyio.from_thread.run_sync(send.close)
+
+# Save tasks run detached from the response so the generator below can be
+# finalized from any task; keep references until they finish.
+_SAVE_TASKS: Set[asyncio.Task] = set()
+
+# A save thread is held for the whole download (it waits on the client), so
+# saves get their own thread budget instead of anyio's shared default pool,
+# which Starlette also uses for upload reads and spooling.
+MAX_CONCURRENT_DOWNLOADS = 16
+_SAVE_LIMITER = anyio.CapacityLimiter(MAX_CONCURRENT_DOWNLOADS)
+
+def _on_save_done(task: asyncio.Task) -> None:
+    _SAVE_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Failed to stream PPTX: {task.exception()}")
+
+async def _iter_presentation(prs):
+    send, recv = anyio.create_memory_object_stream(max_buffer_size=0)
+    # Started on first iteration, so a response that is never read leaves no thread behind
+    task = asyncio.create_task(anyio.to_thread.run_sync(_save_to_channel, prs, send, limiter=_SAVE_LIMITER))
+    _SAVE_TASKS.add(task)
+    task.add_done_callback(_on_save_done)
+    try:
+        async for chunk in recv:
+            yield chunk
+    finally:
+        # Synchronous close: safe from a finalizer, and wakes a blocked save thread
+        # with BrokenResourceError if the client disconnected mid-download.
+        recv.close()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await aclose_http_client()
+
 @app.get("/")
 def root():
     return RedirectResponse(url="/frontend/index.html")
@@ -67,29 +153,30 @@ async def analyze(
     except ValueError:
         pass
 
-    template_bytes = await template.read()
-    if len(template_bytes) > MAX_FILE_SIZE_BYTES:
-        raise HTTPException(413, detail=f"Template too large (> {MAX_FILE_SIZE_BYTES // (1024*1024)} MB).")
+    buf = io.BytesIO()
+    await _stream_to(template, buf, MAX_FILE_SIZE_BYTES)
+
+    # Extract a few reusable images (if any) in a worker thread while the LLM
+    # produces a structured outline; the two don't depend on each other.
+    images_task = asyncio.to_thread(get_template_metadata, buf)
+    llm_task = generate_slide_outline(
+        provider=provider,
+        model=model.strip(),
+        api_key=api_key.strip(),
+        raw_text=text,
+        guidance=guidance,
+    )
+    template_meta, slides_json = await asyncio.gather(images_task, llm_task, return_exceptions=True)
 
-    # Extract a few reusable images (if any) for later re-use
-    try:
-        sample_image_blobs = collect_template_images(io.BytesIO(template_bytes), limit=8)
-    except Exception as e:
-        logger.warning(f"Could not collect images from template: {e}")
+    if isinstance(template_meta, BaseException):
+        logger.warning(f"Could not collect images from template: {template_meta}")
         sample_image_blobs = []
+    else:
+        sample_image_blobs = template_meta[0]
 
-    # Ask the LLM to produce a structured outline
-    try:
-        slides_json = await generate_slide_outline(
-            provider=provider.strip().lower(),
-            model=model.strip(),
-            api_key=api_key.strip(),
-            raw_text=text,
-            guidance=guidance,
-        )
-    except Exception as e:
-        logger.error(f"LLM error: {str(e)} (key={mask_api_key(api_key)})")
-        raise HTTPException(502, detail=f"LLM failed: {str(e)}")
+    if isinstance(slides_json, BaseException):
+        logger.error(f"LLM error: {str(slides_json)} (key={mask_api_key(api_key)})")
+        raise HTTPException(502, detail=f"LLM failed: {str(slides_json)}")
 
     # Validate into our pydantic model
     try:
@@ -120,27 +207,38 @@ async def generate(
     except ValidationError as ve:
         raise HTTPException(422, detail=f"Invalid deck JSON: {ve}")
 
-    template_bytes = await template.read()
-    if len(template_bytes) > MAX_FILE_SIZE_BYTES:
-        raise HTTPException(413, detail=f"Template too large (> {MAX_FILE_SIZE_BYTES // (1024*1024)} MB).")
+    buf = io.BytesIO()
+    await _stream_to(template, buf, MAX_FILE_SIZE_BYTES)
 
-    # If any slide is missing notes and user provided an LLM key, fill them
-    if api_key and provider:
+    # If the deck opts in and an LLM key was provided, fill empty speaker notes
+    missing = [s for s in deck.slides if not (s.notes or "").strip()]
+    if deck.fill_missing_notes and api_key and provider and missing:
         try:
-            deck.fill_missing_notes = True
-            deck.llm = {"provider": provider, "model": model, "api_key": mask_api_key(api_key)}
-        except Exception:
-            pass
-
-    # Build PPTX
+            notes = await fill_missing_notes_batch(
+                provider=provider,
+                model=model.strip(),
+                api_key=api_key.strip(),
+                slides=missing,
+            )
+            for s, n in zip(missing, notes):
+                if n:
+                    s.notes = n
+        except Exception as e:
+            logger.warning(f"Could not fill speaker notes: {str(e)} (key={mask_api_key(api_key)})")
+
+    if _SAVE_LIMITER.available_tokens == 0:
+        raise HTTPException(503, detail="Too many downloads in progress. Try again shortly.")
+
+    # Build PPTX; slides are filled here so errors still surface as a 500,
+    # then the zip is streamed to the client as it is written.
     try:
-        pptx_bytes = build_presentation(io.BytesIO(template_bytes), deck)
+        prs = await asyncio.to_thread(render_presentation, buf, deck)
     except Exception as e:
         raise HTTPException(500, detail=f"Failed to build PPTX: {e}")
 
     filename = "generated_presentation.pptx"
     return StreamingResponse(
-        io.BytesIO(pptx_bytes),
+        _iter_presentation(prs),
         media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
@@ -22,7 +22,4 @@ class SlideDeck(BaseModel):
 
 class AnalyzeResponse(BaseModel):
     deck: SlideDeck
-    theme_summary: dict
-
-class GenerateRequest(BaseModel):
-    deck: SlideDeck
\ No newline at end of file
+    theme_summary: dict
\ No newline at end of file
@@ -1,16 +1,94 @@
+import hashlib
 import io
 import random
-from typing import List
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
 
 from pptx import Presentation
 from pptx.enum.shapes import MSO_SHAPE_TYPE
-from pptx.util import Pt
+from pptx.opc import serialized as _opc_serialized
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls
+from pptx.util import Pt, lazyproperty
 
 from .models import SlideDeck
 
+# .pptx parts are mostly already-compressed PNG/JPEG media, so deflate level 1
+# saves several times faster than zipfile's default (6) for a marginal size
+# increase. python-pptx exposes no option for this, so swap in the writer's zip.
+ZIP_COMPRESSLEVEL = 1
 
-def collect_template_images(template_io: io.BytesIO, limit: int = 8) -> List[bytes]:
-    prs = Presentation(template_io)
+
+def _zipf(self):
+    return zipfile.ZipFile(self._pkg_file, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL)
+
+
+if hasattr(_opc_serialized, "_ZipPkgWriter"):
+    _opc_serialized._ZipPkgWriter._zipf = lazyproperty(_zipf)
+
+
+# Per-template metadata keyed on BLAKE2b(template bytes): (reusable images,
+# lower-cased layout names). Lets /generate skip image harvesting for a
+# template already seen by /analyze. Filled from worker threads, hence the lock.
+# Bounded by entry count and by total image bytes held (LRU eviction); a single
+# template whose images exceed the byte budget is not cached at all.
+_TEMPLATE_CACHE_MAXSIZE = 32
+_TEMPLATE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_TEMPLATE_CACHE: "OrderedDict[bytes, Tuple[List[bytes], List[str]]]" = OrderedDict()
+_TEMPLATE_CACHE_BYTES = 0
+_TEMPLATE_CACHE_LOCK = threading.Lock()
+
+
+def _template_key(template_io: io.BytesIO) -> bytes:
+    with template_io.getbuffer() as view:
+        return hashlib.blake2b(view, digest_size=16).digest()
+
+
+def _cache_get(key: bytes) -> Optional[Tuple[List[bytes], List[str]]]:
+    with _TEMPLATE_CACHE_LOCK:
+        meta = _TEMPLATE_CACHE.get(key)
+        if meta is not None:
+            _TEMPLATE_CACHE.move_to_end(key)
+        return meta
+
+
+def _meta_bytes(meta: Tuple[List[bytes], List[str]]) -> int:
+    return sum(len(b) for b in meta[0])
+
+
+def _cache_put(key: bytes, meta: Tuple[List[bytes], List[str]]) -> None:
+    global _TEMPLATE_CACHE_BYTES
+    size = _meta_bytes(meta)
+    if size > _TEMPLATE_CACHE_MAX_BYTES:
+        return
+    with _TEMPLATE_CACHE_LOCK:
+        old = _TEMPLATE_CACHE.pop(key, None)
+        if old is not None:
+            _TEMPLATE_CACHE_BYTES -= _meta_bytes(old)
+        _TEMPLATE_CACHE[key] = meta
+        _TEMPLATE_CACHE_BYTES += size
+        while len(_TEMPLATE_CACHE) > _TEMPLATE_CACHE_MAXSIZE or _TEMPLATE_CACHE_BYTES > _TEMPLATE_CACHE_MAX_BYTES:
+            _, evicted = _TEMPLATE_CACHE.popitem(last=False)
+            _TEMPLATE_CACHE_BYTES -= _meta_bytes(evicted)
+
+
+def get_template_metadata(template_io: io.BytesIO) -> Tuple[List[bytes], List[str]]:
+    """Return (reusable_images, layout_names) for a template, parsing it only on a cache miss."""
+    key = _template_key(template_io)
+    meta = _cache_get(key)
+    if meta is None:
+        template_io.seek(0)
+        prs = Presentation(template_io)
+        meta = (_harvest_images(prs), _layout_names_lower(prs))
+        _cache_put(key, meta)
+    return meta
+
+
+def _harvest_images(prs: Presentation, limit: int = 8) -> List[bytes]:
     blobs = []
     # Look for images in existing slides (if .pptx) and masters/layouts
     for sl in prs.slides:
@@ -21,58 +99,94 @@ def collect_template_images(template_io: io.BytesIO, limit: int = 8) -> List[byt
                 except Exception:
                     pass
             # background images are trickier; skip for simplicity
-    # Deduplicate and cap
+    # Deduplicate (by content digest) and cap
     uniq = []
     seen = set()
     for b in blobs:
-        if b and (len(b) not in seen):
+        if not b:
+            continue
+        digest = hashlib.blake2b(b, digest_size=16).digest()
+        if digest not in seen:
             uniq.append(b)
-            seen.add(len(b))
+            seen.add(digest)
         if len(uniq) >= limit:
             break
     return uniq
 
 
-def _choose_layout(prs: Presentation, layout_hint: str):
+# Prefer common names (pre-lowered for matching)
+_LAYOUT_PRIORITY = [
+    "title and content",
+    "title and vertical text",
+    "two content",
+    "title only",
+    "section header",
+    "content with caption",
+]
+
+
+def _layout_names_lower(prs: Presentation) -> List[str]:
+    return [(getattr(l, 'name', f'layout-{i}') or f'layout-{i}').lower() for i, l in enumerate(prs.slide_layouts)]
+
+
+def _choose_layout(prs: Presentation, layout_hint: str, names_lower: List[str]):
     # Best effort mapping; fall back to first non-title layout
-    names = [getattr(l, 'name', f'layout-{i}') or f'layout-{i}' for i, l in enumerate(prs.slide_layouts)]
-    # Prefer common names
-    priority = [
-        "Title and Content",
-        "Title and Vertical Text",
-        "Two Content",
-        "Title Only",
-        "Section Header",
-        "Content with Caption",
-    ]
+    layouts = prs.slide_layouts
+    hint = (layout_hint or "").lower()
     # 1) exact match
-    for i, l in enumerate(prs.slide_layouts):
-        if names[i].lower() == (layout_hint or "").lower():
-            return l
+    for i, name in enumerate(names_lower):
+        if name == hint:
+            return layouts[i]
     # 2) priority
-    for want in priority:
-        for i, l in enumerate(prs.slide_layouts):
-            if want.lower() in (names[i] or "").lower():
-                return l
+    for want in _LAYOUT_PRIORITY:
+        for i, name in enumerate(names_lower):
+            if want in name:
+                return layouts[i]
     # 3) fallback
-    return prs.slide_layouts[1 if len(prs.slide_layouts) > 1 else 0]
+    return layouts[1 if len(layouts) > 1 else 0]
+
 
+_LINE_BREAK_RE = re.compile(r"[\n\v]")
+_INVALID_XML_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
 
-def build_presentation(template_io: io.BytesIO, deck: SlideDeck) -> bytes:
+
+def _build_txbody_xml(bullets: List[str]) -> str:
+    """One <a:p> per bullet (line breaks become <a:br/>), wrapped in a txBody for a single parse."""
+    paras = []
+    for b in bullets:
+        lines = _LINE_BREAK_RE.split(b)
+        runs = "<a:br/>".join(f"<a:r><a:t>{escape(_INVALID_XML_CHARS_RE.sub('', ln))}</a:t></a:r>" for ln in lines)
+        paras.append(f"<a:p>{runs}</a:p>")
+    return f"<a:txBody {nsdecls('a')}>{''.join(paras) or '<a:p/>'}</a:txBody>"
+
+
+def render_presentation(template_io: io.BytesIO, deck: SlideDeck) -> Presentation:
+    """Add the deck's slides to the template and return the unsaved Presentation."""
+    key = _template_key(template_io)
     template_io.seek(0)
     prs = Presentation(template_io)
 
-    # Build slides
-    reusable_images = []
-    try:
-        reusable_images = collect_template_images(template_io)
-    except Exception:
-        pass
+    # Reuse cached template metadata, or pull it from the already-open template
+    # (before any slides are added) instead of parsing it a second time.
+    meta = _cache_get(key)
+    if meta is None:
+        try:
+            harvested = _harvest_images(prs)
+        except Exception:
+            harvested = []
+        meta = (harvested, _layout_names_lower(prs))
+        _cache_put(key, meta)
+    reusable_images, names_lower = meta
 
+    # Build slides
     rng = random.Random(42)
+    layout_cache: Dict[str, Any] = {}
 
     for s in deck.slides:
-        layout = _choose_layout(prs, s.layout_hint or "")
+        hint = s.layout_hint or ""
+        layout = layout_cache.get(hint)
+        if layout is None:
+            layout = layout_cache[hint] = _choose_layout(prs, hint, names_lower)
         slide = prs.slides.add_slide(layout)
 
         # Title
@@ -93,14 +207,12 @@ def build_presentation(template_io: io.BytesIO, deck: SlideDeck) -> bytes:
                 body = ph
                 break
         if body is not None:
-            tf = body.text_frame
-            tf.clear()
-            if s.bullets:
-                tf.text = s.bullets[0]
-                for b in s.bullets[1:]:
-                    p = tf.add_paragraph()
-                    p.text = b
-                    p.level = 0
+            # Swap in all paragraphs from one parsed fragment instead of one
+            # python-pptx setter call per bullet; bodyPr/lstStyle are kept.
+            txBody = body.text_frame._txBody
+            for p in txBody.p_lst:
+                txBody.remove(p)
+            txBody.extend(list(parse_xml(_build_txbody_xml(s.bullets))))
 
         # Optional: reuse template images in picture placeholders (if any)
         pics = [ph for ph in slide.placeholders if ph.placeholder_format and ph.placeholder_format.type == 18]  # 18=PICTURE placeholder
@@ -122,6 +234,4 @@ def build_presentation(template_io: io.BytesIO, deck: SlideDeck) -> bytes:
         if slide.notes_slide:
             slide.notes_slide.notes_text_frame.text = s.notes or ""
 
-    bio = io.BytesIO()
-    prs.save(bio)
-    return bio.getvalue()
\ No newline at end of file
+    return prs
\ No newline at end of file
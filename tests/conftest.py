@@ -0,0 +1,14 @@
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def main(monkeypatch):
+    """backend.main, imported from the repo root (the app mounts ./frontend at import time)."""
+    monkeypatch.syspath_prepend(ROOT)
+    monkeypatch.chdir(ROOT)
+    from backend import main as app_main
+    return app_main
@@ -0,0 +1,111 @@
+import asyncio
+import gc
+import io
+import json
+import os
+
+import httpx
+from PIL import Image
+from pptx import Presentation
+from pptx.util import Inches
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PPTX_MIME = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+
+
+def _large_template() -> bytes:
+    # ~2 MB of incompressible pixels so the response spans many chunks
+    img = Image.frombytes("RGB", (820, 820), os.urandom(820 * 820 * 3))
+    png = io.BytesIO()
+    img.save(png, format="PNG")
+    prs = Presentation(os.path.join(ROOT, "sample_template.pptx"))
+    slide = prs.slides.add_slide(prs.slide_layouts[0])
+    slide.shapes.add_picture(io.BytesIO(png.getvalue()), 0, 0, width=Inches(4))
+    out = io.BytesIO()
+    prs.save(out)
+    return out.getvalue()
+
+
+def _generate_request() -> httpx.Request:
+    deck = {"slides": [{"title": "A", "bullets": ["x"], "notes": "n"}]}
+    return httpx.Request(
+        "POST",
+        "http://testserver/generate",
+        data={"deck_json": json.dumps(deck)},
+        files={"template": ("t.pptx", _large_template(), PPTX_MIME)},
+    )
+
+
+async def _disconnect_after_first_chunk(main, request: httpx.Request):
+    body = request.read()
+    first_chunk = asyncio.Event()
+    body_sent = False
+    chunks = []
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append(message["body"])
+            first_chunk.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/generate",
+        "raw_path": b"/generate",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in request.headers.items()],
+        "client": ("testclient", 123),
+        "server": ("testserver", 80),
+    }
+
+    loop_errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, ctx: loop_errors.append(ctx))
+
+    await asyncio.wait_for(main.app(scope, receive, send), timeout=30)
+
+    # Let the abandoned generator be finalized and the save thread wind down
+    gc.collect()
+    for _ in range(100):
+        if not main._SAVE_TASKS:
+            break
+        await asyncio.sleep(0.05)
+
+    return chunks, loop_errors
+
+
+def test_generate_client_disconnect_mid_stream_stops_writer(main):
+    chunks, loop_errors = asyncio.run(_disconnect_after_first_chunk(main, _generate_request()))
+
+    assert chunks, "expected at least one body chunk before disconnect"
+    assert sum(len(c) for c in chunks) < 2 * 1024 * 1024
+    assert not main._SAVE_TASKS, "save thread still blocked after disconnect"
+    assert not loop_errors, loop_errors
+
+
+def test_generate_rejects_when_download_slots_are_full(main, monkeypatch):
+    class _Full:
+        available_tokens = 0
+
+    monkeypatch.setattr(main, "_SAVE_LIMITER", _Full())
+    request = _generate_request()
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.send(request)
+
+    resp = asyncio.run(run())
+    assert resp.status_code == 503